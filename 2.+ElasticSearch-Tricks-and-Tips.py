@@ -32,18 +32,270 @@
 # We will be loading the data from the stored dataframe, and then indexing the data in ES.  We can do queries against it from Python or using the Sense plugin.
 
 from __future__ import print_function
+from itertools import islice
 from pprint import pprint
-import json
+import argparse
+import os
+import time
 
 from elasticsearch import Elasticsearch, client
+from elasticsearch.compat import string_types
+from elasticsearch.helpers import parallel_bulk, scan, streaming_bulk
+from elasticsearch.serializer import JSONSerializer
 import pandas as pd
 
-
-def main():
-    # es = Elasticsearch(hosts=[{'host': 'elasticsearch.aws.blahblah.com', 'port': '9200'}])
-    local_es = Elasticsearch()
-    local_client = client.IndicesClient(local_es)
-
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import pyarrow
+except ImportError:
+    pyarrow = None
+
+
+BULK_CHUNK_SIZE = 1000
+BULK_THREADS = 12
+# parallel_bulk reads its whole input ahead into a queue, so hand it this many actions at a time.
+BULK_WINDOW = BULK_THREADS * BULK_CHUNK_SIZE
+
+# Reviews and businesses each get their own index, rather than two doc types sharing one 'yelp' index.
+REVIEW_INDEX = 'yelp_reviews'
+BUSINESS_INDEX = 'yelp_businesses'
+
+REVIEW_FIELDS = ['text_orig', 'text', 'net_sentiment', 'sent_per_token', 'stars', 'fake_name',
+                 'user_id', 'business_id', 'date', 'review_id']
+REVIEW_COLUMNS = ['text', 'net_sentiment', 'sent_per_token', 'stars', 'fake_name', 'user_id',
+                  'business_id', 'date', 'review_id']
+BUSINESS_FIELDS = ['net_sentiment_median', 'sent_per_token_median', 'stars_median', 'stars_mean',
+                   'fake_name', 'text_length_median', 'business_id', 'reviews']
+
+# Index settings, mappings and queries used in main().  They never change, so build them once here.
+MY_SETTINGS = {
+    "settings": {
+        "analysis": {
+            "char_filter": {
+                "&_to_and": {
+                    "type": "mapping",
+                    "mappings": ["&=> and "]}},
+            "filter": {
+                "my_stopwords": {
+                    "type": "stop",
+                    "stopwords": ["the", "a"]}},
+            "analyzer": {
+                "my_analyzer": {
+                    "type": "custom",
+                    "char_filter": ["html_strip", "&_to_and"],
+                    "tokenizer": "standard",
+                    "filter": ["lowercase", "my_stopwords"]}}
+        }}
+}
+
+# Keep enough pooled connections for all the parallel_bulk threads, and give bulk requests time
+# to finish, retrying ones that time out.
+ES_CLIENT_OPTIONS = {
+    'maxsize': 25,
+    'timeout': 60,
+    'retry_on_timeout': True,
+    'max_retries': 3,
+    'sniff_on_start': False}
+
+# What to bring back for review hits in the demo searches: a few fields, not the review text,
+# and only the parts of the response we look at.
+HIT_SOURCE_FIELDS = ['review_id', 'stars', 'business_id']
+HIT_FILTER_PATH = ['hits.total', 'hits.hits._id', 'hits.hits._score', 'hits.hits._source']
+
+# One shard: on a single local node more shards only add per-query fan-out and a reduce step, not parallelism.
+# (If the index grows past ~20GB a shard, go to a few.)  No refresh and no replicas while bulk loading;
+# finish_bulk_load() turns them back on afterwards.  Used for both the review and business indices.
+YELP_SETTINGS = {
+    "settings": {
+        "number_of_shards": 1,
+        "number_of_replicas": 0,
+        "index.refresh_interval": "-1"}}
+
+MY_MAPPING = {
+    "my_doc_type": {
+        "properties": {
+            "title": {
+                "type": "string",
+                "analyzer": "my_analyzer"
+            }
+        }
+    }
+}
+
+REVIEW_MAPPING = {
+    'review': {
+        'properties': {
+            'business_id': {'index': 'not_analyzed', 'type': 'string'},
+            'date': {'index': 'not_analyzed', 'format': 'dateOptionalTime', 'type': 'date'},
+            'review_id': {'index': 'not_analyzed', 'type': 'string'},
+            'stars': {'index': 'not_analyzed', 'type': 'integer'},
+            # term vectors with positions and offsets are enough for more_like_this and highlighting;
+            # no 'store', since the text is already in _source.
+            'text': {
+                'index': 'analyzed',
+                'analyzer': 'english',
+                "term_vector": "with_positions_offsets",
+                'type': 'string'},
+            'fake_name': {'index': 'not_analyzed', 'type': 'string'},
+            'text_orig': {'index': 'not_analyzed', 'type': 'string'},
+            'user_id': {'index': 'not_analyzed', 'type': 'string'},
+            'net_sentiment': {'index': 'not_analyzed', 'type': 'integer'},
+            'sent_per_token': {'index': 'not_analyzed', 'type': 'float'}}}}
+
+B_MAPPING = {
+    'business': {
+        'properties': {
+            'business_id': {'index': 'not_analyzed', 'type': 'string'},
+            'reviews': {'index': 'not_analyzed', 'type': 'integer'},
+            'stars_median': {'index': 'not_analyzed', 'type': 'float'},
+            'stars_mean': {'index': 'not_analyzed', 'type': 'float'},
+            'text_length_median': {'index': 'not_analyzed', 'type': 'float'},
+            'fake_name': {'index': 'not_analyzed', 'type': 'string'},
+            'net_sentiment_median': {'index': 'not_analyzed', 'type': 'float'},
+            'sent_per_token_median': {'index': 'not_analyzed', 'type': 'float'}}}}
+
+SUGGESTION = {
+    "my-suggestion":
+        {"text": "cheese piza",
+         "term": {"field": "text"}}}
+
+PIZZA_QUERY = {
+    "query": {
+        "match": {
+            "text": {
+                "query": "good pizza",
+                "operator": "and"
+            }
+        }
+    },
+    "aggs": {"businesses": {"terms": {"field": "business_id"}}}}
+
+BUSINESS_ID_QUERY = {
+    "query": {
+        "bool": {
+            "filter": [
+                {"term": {
+                    "business_id": "VVeogjZya58oiTxK7qUjAQ"}}]}}}
+
+
+class ORJSONSerializer(JSONSerializer):
+    ''' The client's JSON serializer, but encoding and decoding in C with orjson. '''
+    def dumps(self, data):
+        # bulk helpers hand over lines that are already serialized
+        if isinstance(data, string_types):
+            return data
+        return orjson.dumps(data, default=self.default, option=orjson.OPT_SERIALIZE_NUMPY).decode('utf-8')
+
+    def loads(self, s):
+        return orjson.loads(s)
+
+
+def load_df(path, columns):
+    ''' Load the given columns from the feather copy of a saved df, making it from the .msg file the first time. '''
+    feather_path = os.path.splitext(path)[0] + '.feather'
+    # Without pyarrow, or with an old pandas like the pinned 0.18, just read the msgpack file.
+    use_feather = pyarrow is not None and hasattr(pd, 'read_feather')
+    if use_feather and os.path.exists(feather_path):
+        return pd.read_feather(feather_path, columns=columns)
+    if not hasattr(pd, 'read_msgpack'):
+        raise IOError("No %s, and pandas %s can't read %s.  Make the .feather file once with pandas 0.24 or 0.25, "
+                      "which can read msgpack and write feather." % (feather_path, pd.__version__, path))
+    df = pd.read_msgpack(path)
+    if not use_feather:
+        return df[columns]
+    df.reset_index(drop=True).to_feather(feather_path)
+    return pd.read_feather(feather_path, columns=columns)
+
+
+def review_actions(df):
+    ''' Generate bulk index actions for the review docs, one per row. '''
+    # to_dict does the row -> dict conversion inside pandas, instead of building each dict by hand.
+    # Doing it a bulk chunk at a time means the dicts are only built as bulk_index() takes them, one window
+    # at a time, rather than all up front.
+    for start in range(0, len(df), BULK_CHUNK_SIZE):
+        chunk = df.iloc[start:start + BULK_CHUNK_SIZE]
+        for source in chunk.assign(text_orig=chunk['text'])[REVIEW_FIELDS].to_dict(orient='records'):
+            yield {"_op_type": "index", "_index": REVIEW_INDEX, "_type": 'review', "_id": source['review_id'],
+                   "_source": source}
+
+
+def business_actions(biz):
+    ''' Generate bulk index actions for the business docs, one per row. '''
+    # Plain tuples from itertuples are cheap, and building each dict as it is needed means
+    # the whole table never sits in memory as a list of dicts.
+    for row in biz[BUSINESS_FIELDS].itertuples(index=False, name=None):
+        source = dict(zip(BUSINESS_FIELDS, row))
+        yield {"_op_type": "index", "_index": BUSINESS_INDEX, "_type": 'business', "_id": source['business_id'],
+               "_source": source}
+
+
+def send_bulk(bulk_helper, es, actions, **kwargs):
+    ''' Send a list of actions with one of the bulk helpers.
+
+    Returns the (action, error info) pairs worth retrying, and the error info for docs that failed for good.
+    '''
+    # A failed item only has the doc's id, not its source, so look the action up in the list we sent.
+    by_id = dict((action['_id'], action) for action in actions)
+    retry, errors = [], []
+    for ok, info in bulk_helper(es, actions, raise_on_error=False, raise_on_exception=False, **kwargs):
+        if ok:
+            continue
+        op_type, item = list(info.items())[0]
+        # 429 means ES was too busy and rejected the doc; 'exception' means the whole request failed
+        # (a timeout, say).  Anything else, like a mapping error, would just fail again.
+        if item.get('status') == 429 or 'exception' in item:
+            retry.append((by_id[item['_id']], info))
+        else:
+            print(info)
+            errors.append(info)
+    return retry, errors
+
+
+def bulk_index(es, actions, max_retries=3, initial_backoff=2):
+    ''' Stream actions to ES in batches over several threads, retrying docs ES was too busy for.
+
+    Prints and returns the error info for every doc that didn't get indexed.
+    '''
+    retry, errors = [], []
+    actions = iter(actions)
+    window = list(islice(actions, BULK_WINDOW))
+    while window:
+        window_retry, window_errors = send_bulk(parallel_bulk, es, window, thread_count=BULK_THREADS,
+                                                chunk_size=BULK_CHUNK_SIZE, max_chunk_bytes=10 * 1024 * 1024)
+        retry.extend(window_retry)
+        errors.extend(window_errors)
+        window = list(islice(actions, BULK_WINDOW))
+
+    # Send the docs ES was too busy for again in smaller chunks, backing off exponentially between tries.
+    for attempt in range(max_retries):
+        if not retry:
+            break
+        time.sleep(initial_backoff * 2 ** attempt)
+        retry, retry_errors = send_bulk(streaming_bulk, es, [action for action, info in retry],
+                                        chunk_size=500, max_chunk_bytes=10 * 1024 * 1024)
+        errors.extend(retry_errors)
+
+    for action, info in retry:
+        print('Gave up on', action['_id'], info)
+        errors.append(info)
+    return errors
+
+
+def finish_bulk_load(es, index):
+    ''' Merge down to one segment after a bulk load, make the docs searchable, and put refresh and replicas back. '''
+    # Merge before adding replicas, so they copy the one merged segment instead of merging all over again.
+    es.indices.forcemerge(index=index, max_num_segments=1)
+    # Refresh was off during the load, so nothing is searchable until we ask for it.
+    es.indices.refresh(index=index)
+    es.indices.put_settings(index=index, body={"index": {"refresh_interval": "30s", "number_of_replicas": 1}})
+
+
+def analyzer_demo(local_es, local_client):
+    ''' Walk through the built-in and custom analyzers on a scratch index, printing what they do. '''
     # ### Analyzers, Defaults, and Preventing Analysis
     #
     # Analysis is the process of chopping up your text and storing it in a form that can be searched efficiently against.
@@ -95,18 +347,18 @@ def main():
     print(local_client.analyze(index='my_index', analyzer='standard', text='My kitty-cat is adorable.'))
 
     # A utility to make analysis results easier to read:
-    def get_analyzer_tokens(result):
-        ''' Utility to combine tokens in an analyzer result. '''
-        tokens = result[u'tokens']
-        print(tokens)
-        return ' '.join([token['token'] for token in tokens])
+    def get_analyzer_tokens(result, debug=False):
+        ''' Utility to combine tokens in an analyzer result. Pass debug=True to see the raw token dicts. '''
+        if debug:
+            print(result[u'tokens'])
+        return ' '.join(token['token'] for token in result[u'tokens'])
 
-    get_analyzer_tokens(local_client.analyze(index='my_index', analyzer="standard", text='My kitty-cat\'s a pain in the neck.'))
+    print(get_analyzer_tokens(local_client.analyze(index='my_index', analyzer="standard", text='My kitty-cat\'s a pain in the neck.')))
 
     # **NB: Prevent analysis with "keyword" analyzer, or set the index itself as "not_analyzed" in settings.**
     #
     # But if you do this, you need to match on EXACT field contents to search for it.  Best to keep an analyzed copy too, if it's meant to be english searchable text.
-    get_analyzer_tokens(local_client.analyze(index='my_index', analyzer='keyword', text='My kitty-cat\'s a pain in the neck.'))
+    print(get_analyzer_tokens(local_client.analyze(index='my_index', analyzer='keyword', text='My kitty-cat\'s a pain in the neck.')))
 
     # ## The Built-In ES "English" Analyzer:
     # ### A useful analyzer for text is the built-in English one, which does this, approximately:
@@ -135,7 +387,7 @@ def main():
     #
     # If you want to customize you can create a new filter yourself or use a file in your config directory for ES.
     # Try it on some text and see...
-    get_analyzer_tokens(local_client.analyze(index='my_index', analyzer='english', text='My kitty-cat\'s a pain in the neck.'))
+    print(get_analyzer_tokens(local_client.analyze(index='my_index', analyzer='english', text='My kitty-cat\'s a pain in the neck.')))
 
     # If you wanted to customize the 'english' analyzer with your own special rules (extra stopwords etc), see here: https://www.elastic.co/guide/en/elasticsearch/guide/current/configuring-language-analyzers.html
     #
@@ -199,38 +451,7 @@ def main():
     #
     # #### Remember: If you don't assign it to a field in a mapping, you aren't using it.
     #
-    # In Python:
-
-    MY_SETTINGS = {
-        "settings": {
-            "analysis": {
-                "char_filter": {
-                    "&_to_and": {
-                        "type": "mapping",
-                        "mappings": ["&=> and "]}},
-                "filter": {
-                    "my_stopwords": {
-                        "type": "stop",
-                        "stopwords": ["the", "a"]}},
-                "analyzer": {
-                    "my_analyzer": {
-                        "type": "custom",
-                        "char_filter": ["html_strip", "&_to_and"],
-                        "tokenizer": "standard",
-                        "filter": ["lowercase", "my_stopwords"]}}
-            }}
-    }
-
-    MAPPING = {
-        "my_doc_type": {
-            "properties": {
-                "title": {
-                    "type": "string",
-                    "analyzer": "my_analyzer"
-                }
-            }
-        }
-    }
+    # In Python, see MY_SETTINGS and MY_MAPPING at the top of this file.
 
     # ## Stopwords Note
     #
@@ -241,112 +462,106 @@ def main():
     # So you can specify both that filter and a custom stopwords list, if you want.
     if local_es.indices.exists('my_index'):
         local_es.indices.delete(index='my_index')
-    local_es.indices.create(index='my_index', body=json.dumps(MY_SETTINGS))
-    local_es.indices.put_mapping(index='my_index', doc_type="my_doc_type", body=json.dumps(MAPPING))
+    local_es.indices.create(index='my_index', body=MY_SETTINGS)
+    local_es.indices.put_mapping(index='my_index', doc_type="my_doc_type", body=MY_MAPPING)
 
     # Check that your mapping looks right!
     print(local_client.get_mapping(index='my_index'))
 
     res = local_client.analyze(index='my_index', analyzer='my_analyzer', text="<p>This is the title & a Capitalized Word!</p>")
-    get_analyzer_tokens(res)
+    print(get_analyzer_tokens(res))
 
     # ## Tokenizers vs. Analyzers - Be Careful.
     #
     # Some of the names in ES are confusing.  There is a **"standard" analyzer** and a **"standard" tokenizer**. https://www.elastic.co/guide/en/elasticsearch/guide/current/standard-tokenizer.html#standard-tokenizer
     #
     # Check them out:
-    get_analyzer_tokens(local_client.analyze(index='my_index', analyzer='standard', text='My kitty-cat\'s not a pain in the \'neck\'!'))
+    print(get_analyzer_tokens(local_client.analyze(index='my_index', analyzer='standard', text='My kitty-cat\'s not a pain in the \'neck\'!')))
 
     #  The difference is subtle but there.
-    get_analyzer_tokens(local_client.analyze(index='my_index', tokenizer="standard", text='My kitty-cat\'s not a pain in the \'neck\'!'))
+    print(get_analyzer_tokens(local_client.analyze(index='my_index', tokenizer="standard", text='My kitty-cat\'s not a pain in the \'neck\'!')))
 
     # However, if you use the english analyzer it will override that uppercase and also remove the negation,
     # because "not" is in the stopwords list:
-    get_analyzer_tokens(local_client.analyze(index='my_index', analyzer="english", tokenizer="standard",
-                                             text='My kitty-cat\'s not a pain in the \'neck\'!'))
+    print(get_analyzer_tokens(local_client.analyze(index='my_index', analyzer="english", tokenizer="standard",
+                                                   text='My kitty-cat\'s not a pain in the \'neck\'!')))
+
+
+def main(demo=False):
+    # es = Elasticsearch(hosts=[{'host': 'elasticsearch.aws.blahblah.com', 'port': '9200'}])
+    # One client for everything below, bulk loading included.  The client serializes dict bodies itself,
+    # so pass dicts, not json.dumps() strings.
+    es_options = dict(hosts=[{'host': 'localhost', 'port': 9200}], **ES_CLIENT_OPTIONS)
+    if orjson:
+        es_options['serializer'] = ORJSONSerializer()
+    local_es = Elasticsearch(**es_options)
+    local_client = client.IndicesClient(local_es)
+
+    # The analyzer walkthrough is just for illustration, so it only runs with --demo.
+    if demo:
+        analyzer_demo(local_es, local_client)
 
     # ## Indexing Yelp Data
-    df = pd.read_msgpack("./data/yelp_df_forES.msg")
+    df = load_df("./data/yelp_df_forES.msg", REVIEW_COLUMNS)
     print(df.head())
 
-    # test with a small sample if you want
-    dfshort = df.query('stars >= 5 and net_sentiment > 35')
-    print(len(dfshort))
-    print(dfshort.head())
+    # test with a small sample if you want (set PREVIEW=1 in the environment to look at it)
+    if os.environ.get('PREVIEW'):
+        dfshort = df.query('stars >= 5 and net_sentiment > 35')
+        print(len(dfshort))
+        print(dfshort.head())
 
     # filter out any rows with a nan for sent_per_token, which breaks bulk load:
-    df = df[df.sent_per_token.isnull() != True]
-
-    MAPPING = {
-        'review': {
-            'properties': {
-                'business_id': {'index': 'not_analyzed', 'type': 'string'},
-                'date': {'index': 'not_analyzed', 'format': 'dateOptionalTime', 'type': 'date'},
-                'review_id': {'index': 'not_analyzed', 'type': 'string'},
-                'stars': {'index': 'not_analyzed', 'type': 'integer'},
-                'text': {
-                    'index': 'analyzed',
-                    'analyzer': 'english',
-                    'store': 'yes',
-                    "term_vector": "with_positions_offsets_payloads",
-                    'type': 'string'},
-                'fake_name': {'index': 'not_analyzed', 'type': 'string'},
-                'text_orig': {'index': 'not_analyzed', 'type': 'string'},
-                'user_id': {'index': 'not_analyzed', 'type': 'string'},
-                'net_sentiment': {'index': 'not_analyzed', 'type': 'integer'},
-                'sent_per_token': {'index': 'not_analyzed', 'type': 'float'}}}}
-
-    if local_es.indices.exists('yelp'):
-        local_es.indices.delete(index='yelp')
-    local_es.indices.create(index='yelp')
-    local_es.indices.put_mapping(index='yelp', doc_type='review', body=json.dumps(MAPPING))
-
-    # Bulk data is structured as alternating opt_dict and data dicts.
-    bulk_data = []
-
-    for index, row in df.iterrows():
-        data_dict = {}
-        data_dict['text_orig'] = row['text']
-        data_dict['text'] = row['text']
-        data_dict['net_sentiment'] = row['net_sentiment']
-        data_dict['sent_per_token'] = row['sent_per_token']
-        data_dict['stars'] = row['stars']
-        data_dict['fake_name'] = row['fake_name']
-        data_dict['user_id'] = row['user_id']
-        data_dict['business_id'] = row['business_id']
-        data_dict['date'] = row['date']
-        data_dict['review_id'] = row['review_id']
-        op_dict = {
-            "index": {
-                "_index": 'yelp',
-                "_type": 'review',
-                "_id": row['review_id']}}
-        bulk_data.append(op_dict)
-        bulk_data.append(data_dict)
-
-    pprint(bulk_data[0])
-    pprint(bulk_data[1])
-    print(len(bulk_data))
-
-    # May time out with a large bulk_data bump or error and fail without any reason.  Mine did, so see below.
-    # res = local_es.bulk(index = 'yelp', body = bulk_data)
-
-    # In order to find the error, I did them one-by-one, with a try.
-    for ind, obj in enumerate(bulk_data):
-        # every other one is the data, so use those to do it one by one
-        if ind % 2 != 0:
-            try:
-                local_es.index(index='yelp', doc_type='review', id=obj['review_id'], body=json.dumps(obj))
-            except:
-                print(obj)
-
-    local_es.search(index='yelp', doc_type='review', q='pizza-cookie')
+    # (in place, so there's no second copy of the frame; dropping the old index frees its buffer too)
+    df.dropna(subset=['sent_per_token'], inplace=True)
+    df.reset_index(drop=True, inplace=True)
+
+    if local_es.indices.exists(REVIEW_INDEX):
+        local_es.indices.delete(index=REVIEW_INDEX)
+    local_es.indices.create(index=REVIEW_INDEX, body=YELP_SETTINGS)
+    local_es.indices.put_mapping(index=REVIEW_INDEX, doc_type='review', body=REVIEW_MAPPING)
+
+    # A single local_es.bulk() with everything in it may time out with a large bump, or error and fail
+    # without any reason.  Mine did.  Instead, stream the docs from a generator in chunks of 1000
+    # over several threads, retry the docs that fail, and print the ones that still fail so you can find the error.
+    bulk_index(local_es, review_actions(df))
+    finish_bulk_load(local_es, REVIEW_INDEX)
+
+    # Only fetch a few small fields for each hit; the review text makes up almost all of a doc.
+    pprint(local_es.search(index=REVIEW_INDEX, doc_type='review', q='pizza-cookie', size=10,
+                           _source=HIT_SOURCE_FIELDS, filter_path=HIT_FILTER_PATH))
 
     # Remember that score relevancy results are based on the indexed TF-IDF for the doc and docs:
     #     https://www.elastic.co/guide/en/elasticsearch/guide/current/relevance-intro.html
 
     # Want to explain why something matched?  You need the id of the matched doc.
-    local_es.explain(index='yelp', doc_type='review', q='pizza-cookie', id=u'fmn5yGrPChOYMR2vGOIrYA')
+    local_es.explain(index=REVIEW_INDEX, doc_type='review', q='pizza-cookie', id=u'fmn5yGrPChOYMR2vGOIrYA')
+
+    # ### Reading More Than One Page of Results
+    #
+    # Don't page with from/size: for every page, each shard has to rank from + size hits all over again.
+    # To read everything, scroll through it with the scan helper.  Here, counting reviews per star rating:
+    star_counts = {}
+    for hit in scan(local_es, index=REVIEW_INDEX, doc_type='review', query={"query": {"match_all": {}}},
+                    size=1000, scroll='5m', _source=['review_id', 'stars']):
+        stars = hit['_source']['stars']
+        star_counts[stars] = star_counts.get(stars, 0) + 1
+    print(star_counts)
+
+    # To page through hits for a user on ES 5.0 or later, sort by score with review_id as a tie-breaker, and
+    # hand the sort values of the last hit on a page to search_after to get the next page.  (ES 2.x doesn't
+    # have search_after and rejects the query; the scan helper above is the 2.x way.)
+    #
+    #     page_query = {
+    #         "query": {"match": {"text": "pizza"}},
+    #         "sort": [{"_score": "desc"}, {"review_id": "asc"}]}
+    #     for page in range(2):
+    #         hits = local_es.search(index=REVIEW_INDEX, doc_type='review', body=page_query, size=10,
+    #                                _source=HIT_SOURCE_FIELDS)['hits']['hits']
+    #         pprint(hits)
+    #         if not hits:
+    #             break
+    #         page_query['search_after'] = hits[-1]['sort']
 
     # ### More Like This
     #
@@ -354,30 +569,29 @@ def main():
     # https://www.elastic.co/guide/en/elasticsearch/reference/2.3/query-dsl-mlt-query.html
     #
     #
-    text = df.iloc[0].text
-    print(text)
+    # Rather than sending the review's text, point at the indexed review and ES reads its term vectors itself.
+    # max_query_terms caps how many of its terms go into the generated query.
+    review = df.iloc[0]
+    print(review.text)
 
-    QUERY = {
+    # This one depends on the data, so it is built here rather than at the top of the file.
+    mlt_query = {
         "query": {
             "more_like_this": {
                 "fields": ["text"],
-                "like_text": text,
-                "analyzer": "english",
-                "min_term_freq": 2}}}
+                "like": [{"_index": REVIEW_INDEX, "_type": "review", "_id": review.review_id}],
+                "min_term_freq": 2,
+                "max_query_terms": 25}}}
 
     # Result is not brilliant, though.  You could limit the hits unless a score threshold is hit.
-    pprint(local_es.search(index='yelp', doc_type='review', body=json.dumps(QUERY)))
+    pprint(local_es.search(index=REVIEW_INDEX, doc_type='review', body=mlt_query,
+                           _source=HIT_SOURCE_FIELDS, filter_path=HIT_FILTER_PATH))
 
     # ### Suggestions: For Mispellings
     #
     # Can be added to queries too, to help if there are no matches.  Still in development, though. See: https://www.elastic.co/guide/en/elasticsearch/reference/current/search-suggesters.html#search-suggesters
-    SUGGESTION = {
-        "my-suggestion":
-            {"text": "cheese piza",
-             "term": {"field": "text"}}}
-
     # I don't love the results, tbh.  Fail on cheese.
-    pprint(local_es.suggest(index='yelp', body=SUGGESTION))
+    pprint(local_es.suggest(index=REVIEW_INDEX, body=SUGGESTION))
 
     # ## Reminders:
     # * check your mapping on your fields
@@ -386,79 +600,33 @@ def main():
     # * use multi-fields to be sure of matches that may need stopwords too
 
     # ## Let's Index the Businesses too
-    biz = pd.read_msgpack("data/biz_stats_df.msg")
+    biz = load_df("data/biz_stats_df.msg", BUSINESS_FIELDS)
     print(len(biz))
     pprint(biz[0:2])
 
-    B_MAPPING = {
-        'business': {
-            'properties': {
-                'business_id': {'index': 'not_analyzed', 'type': 'string'},
-                'reviews': {'index': 'not_analyzed', 'type': 'integer'},
-                'stars_median': {'index': 'not_analyzed', 'type': 'float'},
-                'stars_mean': {'index': 'not_analyzed', 'type': 'float'},
-                'text_length_median': {'index': 'not_analyzed', 'type': 'float'},
-                'fake_name': {'index': 'not_analyzed', 'type': 'string'},
-                'net_sentiment_median': {'index': 'not_analyzed', 'type': 'float'},
-                'sent_per_token_median': {'index': 'not_analyzed', 'type': 'float'}}}}
-
-    # local_es.indices.delete(index='yelp')  # nb: this errors the first time you run it. comment out.
-    # local_es.indices.create(index='yelp')  # do not do this is you already made the reviews!
-    local_es.indices.put_mapping(index='yelp', doc_type='business', body=json.dumps(B_MAPPING))
-
-    bulk_data = []
-
-    for index, row in biz.iterrows():
-        data_dict = {}
-        data_dict['net_sentiment_median'] = row['net_sentiment_median']
-        data_dict['sent_per_token_median'] = row['sent_per_token_median']
-        data_dict['stars_median'] = row['stars_median']
-        data_dict['stars_mean'] = row['stars_mean']
-        data_dict['fake_name'] = row['fake_name']
-        data_dict['text_length_median'] = row['text_length_median']
-        data_dict['business_id'] = row['business_id']
-        data_dict['reviews'] = row['reviews']
-        op_dict = {
-            "index": {
-                "_index": 'yelp',
-                "_type": 'business',
-                "_id": row['business_id']}}
-        bulk_data.append(op_dict)
-        bulk_data.append(data_dict)
-
-    # May time out with a large bulk_data bump or error and fail without any reason.  Mine did, so see below.
-    res = local_es.bulk(index='yelp', body=bulk_data)
-
-
-    print(local_es.search(index='yelp', doc_type='business', q='JokKtdXU7zXHcr20Lrk29A'))
+    # They go in an index of their own, so this doesn't touch the reviews.
+    if local_es.indices.exists(BUSINESS_INDEX):
+        local_es.indices.delete(index=BUSINESS_INDEX)
+    local_es.indices.create(index=BUSINESS_INDEX, body=YELP_SETTINGS)
+    local_es.indices.put_mapping(index=BUSINESS_INDEX, doc_type='business', body=B_MAPPING)
+
+    bulk_index(local_es, business_actions(biz))
+    finish_bulk_load(local_es, BUSINESS_INDEX)
+
+    print(local_es.search(index=BUSINESS_INDEX, doc_type='business', q='JokKtdXU7zXHcr20Lrk29A'))
 
     # ## Aggregate Queries to get Business ID's and More
     #
     #
     # Here we are using the operator "and" to make sure all words in the search match, and then getting counts of matching business id's.
-    QUERY = {
-        "query": {
-            "match": {
-                "text": {
-                    "query": "good pizza",
-                    "operator": "and"
-                }
-            }
-        },
-        "aggs": {"businesses": {"terms": {"field": "business_id"}}}}
-
-    pprint(local_es.search(index="yelp", doc_type="review", body=json.dumps(QUERY)))
+    # We only want the aggregation counts, not the hits: size=0 also lets ES keep the result in the shard request cache.
+    pprint(local_es.search(index=REVIEW_INDEX, doc_type="review", body=PIZZA_QUERY, size=0, request_cache=True,
+                           filter_path=['hits.total', 'aggregations.*']))
 
     # exact match on field: https://www.elastic.co/guide/en/elasticsearch/guide/master/_finding_exact_values.html
     # requires not indexed field for the match
-    QUERY = {
-        "query": {
-            "constant_score": {
-                "filter": {
-                    "term": {
-                        "business_id": "VVeogjZya58oiTxK7qUjAQ"}}}}}
-
-    pprint(local_es.search(index="yelp", doc_type="business", body=json.dumps(QUERY)))
+    # Putting the term in filter context skips scoring and lets ES cache the matching docs for repeat lookups.
+    pprint(local_es.search(index=BUSINESS_INDEX, doc_type="business", body=BUSINESS_ID_QUERY, request_cache=True))
 
     # ## Now Move to The JS App
     #
@@ -471,4 +639,6 @@ def main():
     #
 
 if __name__ == '__main__':
-    main()
+    parser = argparse.ArgumentParser(description='Index the Yelp reviews and businesses in ES, and query them.')
+    parser.add_argument('--demo', action='store_true', help='also run the analyzer examples first')
+    main(demo=parser.parse_args().demo)